@@ -4,12 +4,23 @@ Simple Homebridge MCP Server - Control HomeKit accessories through Homebridge Co
 """
 import os
 import sys
+import asyncio
 import logging
-from datetime import datetime, timezone
+import random
+import re
+import time
+import types
+from contextlib import asynccontextmanager, suppress
 import httpx
-import json
+import orjson
+from aiolimiter import AsyncLimiter
 from mcp.server.fastmcp import FastMCP
 
+try:
+    import ijson  # Optional: lets list_accessories stream large responses
+except ImportError:
+    ijson = None
+
 # Configure logging to stderr
 logging.basicConfig(
     level=logging.INFO,
@@ -18,47 +29,163 @@ logging.basicConfig(
 )
 logger = logging.getLogger("homebridge-server")
 
-# Initialize MCP server - NO PROMPT PARAMETER!
-mcp = FastMCP("homebridge")
+def _positive_env(name, default, cast):
+    """Read a numeric setting from the environment, rejecting values that are not above zero."""
+    value = cast(os.environ.get(name, default))
+    if value <= 0:
+        raise ValueError(f"{name} must be greater than 0, got {value}")
+    return value
 
 # Configuration
 HOMEBRIDGE_HOST = os.environ.get("HOMEBRIDGE_HOST", "homebridge.local:8081")
 HOMEBRIDGE_BASE_URL = f"http://{HOMEBRIDGE_HOST}"
+HOMEBRIDGE_MAX_CONCURRENCY = _positive_env("HOMEBRIDGE_MAX_CONCURRENCY", "6", int)
+HOMEBRIDGE_RPS = _positive_env("HOMEBRIDGE_RPS", "10", float)
+
+# Per-accessory endpoint, relative to the shared client's base_url
+_ACC_PATH = "/api/accessories/{}"
 
 # Token cache
 _auth_token = None
 _token_expires = None
+_token_lock = asyncio.Lock()
+
+# Shared HTTP client (keeps connections alive between requests)
+_client: httpx.AsyncClient | None = None
+_client_lock = asyncio.Lock()
+
+# Retry policy for transient Homebridge failures
+_MAX_ATTEMPTS = 3
+_RETRY_STATUSES = frozenset({429, 502, 503, 504})
+_MAX_RETRY_DELAY = 5.0
+
+# Short-lived cache of the /api/accessories listing: (fetched_at, data)
+_accessories_cache: tuple[float, list] | None = None
+# Bumped on every invalidation so fetches that overlap a state change are not cached
+_accessories_generation = 0
+# Streamed listings larger than this are not kept, so they stay out of memory
+_STREAM_CACHE_MAX = 200
+
+# (unique_id, action) -> (characteristicType, accessory name) for control_accessory
+_char_type_cache: dict[tuple[str, str], tuple[str, str]] = {}
+
+# Hard cap on requests in flight to Homebridge across all tools
+_api_sem = asyncio.Semaphore(HOMEBRIDGE_MAX_CONCURRENCY)
+
+# Smooths bursts to at most HOMEBRIDGE_RPS requests per second. Below 1 rps the
+# bucket must still hold one whole request, so spread one request over a longer period.
+if HOMEBRIDGE_RPS >= 1:
+    _rate = AsyncLimiter(HOMEBRIDGE_RPS, 1.0)
+else:
+    _rate = AsyncLimiter(1, 1.0 / HOMEBRIDGE_RPS)
+
+# Limits how many accessories control_room_devices updates at once
+_room_sem = asyncio.Semaphore(8)
 
 # === UTILITY FUNCTIONS ===
 
+async def _get_client():
+    """Get the shared HTTP client, creating it on first use."""
+    global _client
+    
+    if _client is None:
+        async with _client_lock:
+            if _client is None:
+                _client = httpx.AsyncClient(
+                    base_url=HOMEBRIDGE_BASE_URL,
+                    limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+                    timeout=10.0
+                )
+    return _client
+
+async def _close_client():
+    """Close the shared HTTP client if it was created."""
+    global _client
+    
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+@asynccontextmanager
+async def server_lifespan(server):
+    """Prefetch an auth token on startup and release the shared HTTP client on shutdown."""
+    warmup = asyncio.create_task(_warmup())
+    try:
+        yield {}
+    finally:
+        # Let a still-running warmup finish unwinding before its client is closed
+        warmup.cancel()
+        with suppress(asyncio.CancelledError):
+            await warmup
+        await _close_client()
+
 async def get_auth_token():
     """Get authentication token from Homebridge API."""
     global _auth_token, _token_expires
     
     # Check if we have a valid cached token
-    if _auth_token and _token_expires and datetime.now(timezone.utc) < _token_expires:
+    if _auth_token and _token_expires and time.monotonic() < _token_expires:
         return _auth_token
     
-    try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.post(f"{HOMEBRIDGE_BASE_URL}/api/auth/noauth")
+    async with _token_lock:
+        # Another caller may have refreshed the token while we waited
+        if _auth_token and _token_expires and time.monotonic() < _token_expires:
+            return _auth_token
+        
+        try:
+            client = await _get_client()
+            response = await client.post("/api/auth/noauth")
             response.raise_for_status()
             
-            token_data = response.json()
+            token_data = orjson.loads(response.content)
             _auth_token = token_data.get("access_token")
             expires_in = token_data.get("expires_in", 3600)
             
             # Calculate expiration time (subtract 5 minutes for buffer)
-            _token_expires = datetime.now(timezone.utc).replace(tzinfo=None)
-            _token_expires = _token_expires.timestamp() + expires_in - 300
-            _token_expires = datetime.fromtimestamp(_token_expires, tz=timezone.utc)
+            _token_expires = time.monotonic() + int(expires_in) - 300
             
             logger.info("Successfully obtained auth token")
             return _auth_token
             
-    except Exception as e:
-        logger.error(f"Failed to get auth token: {e}")
-        return None
+        except Exception as e:
+            logger.error(f"Failed to get auth token: {e}")
+            return None
+
+def _retry_delay(attempt, retry_after=None):
+    """Seconds to wait before retrying, honouring Retry-After when it is numeric."""
+    if retry_after:
+        try:
+            return min(float(retry_after), _MAX_RETRY_DELAY)
+        except ValueError:
+            pass
+    return (2 ** attempt) * 0.1 + random.random() * 0.1
+
+async def _with_retries(method, endpoint, send, can_retry=None):
+    """Run send() under the transient-failure retry policy; returns (result, error).
+    
+    can_retry, when given, is checked before retrying a connection or read error.
+    """
+    for attempt in range(_MAX_ATTEMPTS):
+        retries_left = attempt < _MAX_ATTEMPTS - 1
+        try:
+            return await send(), None
+            
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code in _RETRY_STATUSES and retries_left:
+                delay = _retry_delay(attempt, e.response.headers.get("Retry-After"))
+                logger.warning("%s %s returned HTTP %s, retrying in %.2fs", method, endpoint, e.response.status_code, delay)
+                await asyncio.sleep(delay)
+                continue
+            return None, f"HTTP {e.response.status_code}: {e.response.text}"
+        except (httpx.ConnectError, httpx.ReadTimeout) as e:
+            if retries_left and (can_retry is None or can_retry()):
+                delay = _retry_delay(attempt)
+                logger.warning("%s %s failed (%s), retrying in %.2fs", method, endpoint, e, delay)
+                await asyncio.sleep(delay)
+                continue
+            return None, str(e)
+        except Exception as e:
+            return None, str(e)
 
 async def make_api_request(method, endpoint, data=None):
     """Make authenticated API request to Homebridge."""
@@ -71,103 +198,316 @@ async def make_api_request(method, endpoint, data=None):
         "Content-Type": "application/json"
     }
     
-    try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            if method.upper() == "GET":
-                response = await client.get(f"{HOMEBRIDGE_BASE_URL}{endpoint}", headers=headers)
-            elif method.upper() == "PUT":
-                response = await client.put(f"{HOMEBRIDGE_BASE_URL}{endpoint}", headers=headers, json=data)
-            else:
-                return None, f"Unsupported HTTP method: {method}"
-            
-            response.raise_for_status()
-            return response.json(), None
-            
-    except httpx.HTTPStatusError as e:
-        return None, f"HTTP {e.response.status_code}: {e.response.text}"
-    except Exception as e:
-        return None, str(e)
+    if method.upper() not in ("GET", "PUT"):
+        return None, f"Unsupported HTTP method: {method}"
+    
+    body = orjson.dumps(data) if data is not None else None
+    
+    async def _send():
+        client = await _get_client()
+        async with _rate, _api_sem:
+            response = await client.request(method.upper(), endpoint, headers=headers, content=body)
+        response.raise_for_status()
+        # Some endpoints (e.g. reset-cached-accessories) reply with an empty body
+        return orjson.loads(response.content) if response.content else None
+    
+    return await _with_retries(method.upper(), endpoint, _send)
+
+class _AsyncByteReader:
+    """Async file-like wrapper over an async byte iterator, as ijson expects."""
+    
+    def __init__(self, chunks):
+        self._chunks = chunks
+    
+    async def read(self, size=-1):
+        # ijson probes with read(0) to detect bytes vs str
+        if size == 0:
+            return b""
+        async for chunk in self._chunks:
+            if chunk:
+                return chunk
+        return b""
+
+async def stream_api_items(endpoint, on_item):
+    """Stream a JSON array from Homebridge, calling on_item per element; returns (count, error)."""
+    token = await get_auth_token()
+    if not token:
+        return 0, "Failed to authenticate with Homebridge"
+    
+    headers = {"Authorization": f"Bearer {token}"}
+    count = 0
+    
+    async def _send():
+        nonlocal count
+        client = await _get_client()
+        async with _rate, _api_sem:
+            async with client.stream("GET", endpoint, headers=headers) as response:
+                if response.is_error:
+                    await response.aread()
+                response.raise_for_status()
+                
+                reader = _AsyncByteReader(response.aiter_bytes())
+                async for item in ijson.items(reader, "item", use_float=True):
+                    on_item(item)
+                    count += 1
+        return count
+    
+    # Only retry before anything was handed to on_item, so items are never repeated
+    result, error = await _with_retries("GET", endpoint, _send, can_retry=lambda: count == 0)
+    if error:
+        return 0, error
+    return result, None
+
+def _fresh_accessories(ttl=5.0):
+    """Return the cached accessories list if it is younger than ttl seconds, else None."""
+    if _accessories_cache and time.monotonic() - _accessories_cache[0] < ttl:
+        return _accessories_cache[1]
+    return None
 
-def format_accessory_info(accessory):
-    """Format accessory information for display."""
-    name = accessory.get("serviceName", "Unknown")
-    service_type = accessory.get("serviceType", "Unknown")
-    unique_id = accessory.get("uniqueId", "")
-    room = accessory.get("customName", "")
+def _store_accessories(data, generation):
+    """Remember a fetched accessories list unless it was invalidated since the fetch started."""
+    global _accessories_cache
+    if generation == _accessories_generation:
+        _accessories_cache = (time.monotonic(), data)
+
+async def _get_accessories(ttl=5.0):
+    """Get the accessories list, reusing a recent response when available."""
+    cached = _fresh_accessories(ttl)
+    if cached is not None:
+        return cached, None
     
+    generation = _accessories_generation
+    data, error = await make_api_request("GET", "/api/accessories")
+    if not error:
+        _store_accessories(data, generation)
+    return data, error
+
+def _invalidate_accessories():
+    """Drop the cached accessories list after a state change."""
+    global _accessories_cache, _accessories_generation
+    _accessories_cache = None
+    _accessories_generation += 1
+
+async def _warmup():
+    """Fetch an auth token at startup so the first tool call does not have to."""
+    started = time.monotonic()
+    
+    if not await get_auth_token():
+        logger.warning("Warmup skipped: could not authenticate with Homebridge")
+        return
+    
+    logger.info("Auth token prefetched in %.0f ms", (time.monotonic() - started) * 1000)
+
+# Characteristic short names (e.g. "On") for each control action
+_ACTION_TO_CHARNAME = types.MappingProxyType({
+    "power": "On",
+    "on": "On",
+    "off": "On",
+    "brightness": "Brightness",
+    "hue": "Hue",
+    "saturation": "Saturation"
+})
+
+# Action reported for each controllable characteristic
+_CHAR_TO_ACTION = types.MappingProxyType({
+    "On": "power",
+    "Brightness": "brightness",
+    "Hue": "hue",
+    "Saturation": "saturation"
+})
+
+# Display label and formatted value for each known characteristic
+_CHAR_FORMATTERS = types.MappingProxyType({
+    "On": lambda v: ("Power", "On" if v else "Off"),
+    "Brightness": lambda v: ("Brightness", f"{v}%"),
+    "Hue": lambda v: ("Hue", f"{v}°"),
+    "Saturation": lambda v: ("Saturation", f"{v}%")
+})
+
+# Room keywords for create_room_groups. Each branch is a lookahead anchored at the
+# start of the name, so earlier groups win regardless of where the keyword appears.
+_ROOM_RE = re.compile(
+    r"(?=.*?(?P<Sala>sala|living|salon))"
+    r"|(?=.*?(?P<Comedor>comedor|dining))"
+    r"|(?=.*?(?P<Entrada>entrada|entry|hall))"
+    r"|(?=.*?(?P<Jardin>jardin|garden|patio))"
+    r"|(?=.*?(?P<Garage>garage))"
+    r"|(?=.*?(?P<Decoracion>navidad|christmas|arbol))"
+    r"|(?=.*?(?P<Luz>luz|light))"
+    r"|(?=.*?(?P<Switch>switch))",
+    re.IGNORECASE | re.DOTALL
+)
+_SIDE_RE = re.compile(
+    r"(?=.*?(?P<Derecha>derecha|right))|(?=.*?(?P<Izquierda>izquierda|left))",
+    re.IGNORECASE | re.DOTALL
+)
+
+# Suggested group name for each _ROOM_RE / _SIDE_RE match
+_ROOM_LABELS = types.MappingProxyType({
+    "Sala": "Sala",
+    "Comedor": "Comedor",
+    "Entrada": "Entrada",
+    "Jardin": "Jardín",
+    "Garage": "Garage",
+    "Decoracion": "Decoración",
+    "Switch": "Switches"
+})
+_SIDE_LABELS = types.MappingProxyType({
+    "Derecha": "Luces - Derecha",
+    "Izquierda": "Luces - Izquierda"
+})
+
+def _short(char_type):
+    """Strip any namespace prefix from a characteristic type (e.g. "x.On" -> "On")."""
+    return char_type.rsplit(".", 1)[-1] if "." in char_type else char_type
+
+def _emit_accessory(parts, accessory):
+    """Append the display lines for an accessory to parts."""
     # Extract current values
     values = {}
     for char in accessory.get("serviceCharacteristics", []):
-        char_type = char.get("type", "")
-        value = char.get("value")
-        if "On" in char_type:
-            values["Power"] = "On" if value else "Off"
-        elif "Brightness" in char_type:
-            values["Brightness"] = f"{value}%"
-        elif "Hue" in char_type:
-            values["Hue"] = f"{value}°"
-        elif "Saturation" in char_type:
-            values["Saturation"] = f"{value}%"
-    
-    status = " | ".join([f"{k}: {v}" for k, v in values.items()])
-    
-    return f"🏠 {name} ({service_type})\n   ID: {unique_id}\n   Room: {room}\n   Status: {status}"
+        fmt = _CHAR_FORMATTERS.get(_short(char.get("type", "")))
+        if fmt:
+            label, shown = fmt(char.get("value"))
+            values[label] = shown
+    
+    parts.append(f"🏠 {accessory.get('serviceName', 'Unknown')} ({accessory.get('serviceType', 'Unknown')})")
+    parts.append(f"   ID: {accessory.get('uniqueId', '')}")
+    parts.append(f"   Room: {accessory.get('customName', '')}")
+    parts.append("   Status: " + " | ".join(f"{k}: {v}" for k, v in values.items()))
 
 # HomeKit characteristic UUID mappings
-HOMEKIT_CHARACTERISTIC_UUIDS = {
+HOMEKIT_CHARACTERISTIC_UUIDS = types.MappingProxyType({
     "On": "00000025-0000-1000-8000-0026BB765291",
     "Brightness": "00000008-0000-1000-8000-0026BB765291", 
     "Hue": "00000013-0000-1000-8000-0026BB765291",
     "Saturation": "0000002F-0000-1000-8000-0026BB765291",
     "OutletInUse": "00000026-0000-1000-8000-0026BB765291"
-}
+})
+
+# Actions that control power, and values that mean "on"
+_POWER_ACTIONS = frozenset({"power", "on", "off"})
+_TRUTHY = frozenset({"on", "true", "1", "yes"})
 
 def find_characteristic_by_action(characteristics, action):
     """Find the appropriate characteristic based on action type."""
-    action_lower = action.lower()
+    wanted = _ACTION_TO_CHARNAME.get(action.lower())
+    if not wanted:
+        return None
     
-    for char in characteristics:
-        char_type = char.get("type", "")
-        can_write = char.get("canWrite", False)
+    # Return the characteristic as-is so its original type is sent back
+    return next(
+        (c for c in characteristics if c.get("canWrite", False) and _short(c.get("type", "")) == wanted),
+        None
+    )
+
+async def _discover_characteristic(unique_id, action):
+    """Look up the writable characteristic type for an action; returns (type, name, error)."""
+    current_data, error = await make_api_request("GET", _ACC_PATH.format(unique_id))
+    if error:
+        return None, None, f"❌ Error fetching current state: {error}"
+    
+    if not current_data:
+        return None, None, f"❌ Accessory not found: {unique_id}"
+    
+    # Find the appropriate characteristic for this action
+    characteristics = current_data.get("serviceCharacteristics", [])
+    target_char = find_characteristic_by_action(characteristics, action)
+    
+    if not target_char:
+        # De-duplicate while scanning so the list keeps characteristic order
+        seen = set()
+        available_actions = []
+        for char in characteristics:
+            if char.get("canWrite", False):
+                action_name = _CHAR_TO_ACTION.get(_short(char.get("type", "")))
+                if action_name and action_name not in seen:
+                    seen.add(action_name)
+                    available_actions.append(action_name)
         
-        if not can_write:
-            continue
-            
-        # Map actions to characteristic type patterns
-        if action_lower in ["power", "on", "off"] and "On" in char_type:
-            return char  # Return the characteristic as-is with original type
-        elif action_lower == "brightness" and "Brightness" in char_type:
-            return char
-        elif action_lower == "hue" and "Hue" in char_type:
-            return char
-        elif action_lower == "saturation" and "Saturation" in char_type:
-            return char
+        available_str = ", ".join(available_actions) if available_actions else "none"
+        return None, None, f"❌ Error: action '{action}' not supported. Available actions: {available_str}"
     
-    return None
+    # Use the exact type from the characteristic (e.g., "On")
+    return target_char["type"], current_data.get("serviceName", unique_id), None
+
+async def _set_power(unique_id, power_char, target=None):
+    """Set an accessory's power, toggling it when target is None; returns (ok, message)."""
+    current_power = power_char.get("value")
+    new_power = not bool(current_power) if target is None else target
+    
+    # Use the correct format from Swagger documentation
+    payload = {
+        "characteristicType": power_char["type"],  # Use the actual type from the characteristic (e.g., "On")
+        "value": new_power
+    }
+    
+    logger.info("Sending power payload: %s", payload)
+    
+    result, error = await make_api_request("PUT", _ACC_PATH.format(unique_id), payload)
+    if error:
+        return False, error
+    
+    _invalidate_accessories()
+    
+    new_state = "🟢 On" if new_power else "🔴 Off"
+    if target is not None:
+        return True, new_state
+    
+    old_state = "🟢 On" if current_power else "🔴 Off"
+    return True, f"{old_state} → {new_state}"
 
 # === MCP TOOLS ===
 
+# Initialize MCP server - NO PROMPT PARAMETER!
+mcp = FastMCP("homebridge", lifespan=server_lifespan)
+
 @mcp.tool()
 async def list_accessories() -> str:
     """List all HomeKit accessories available in Homebridge."""
     logger.info("Fetching accessories list")
     
-    data, error = await make_api_request("GET", "/api/accessories")
+    if ijson is not None and _fresh_accessories() is None:
+        # Format each accessory as it arrives instead of parsing the whole response first
+        parts = [""]
+        received = []
+        generation = _accessories_generation
+        
+        def _on_accessory(accessory):
+            nonlocal received
+            # Keep small listings for the cache; drop them once the home is large
+            if received is not None:
+                received.append(accessory)
+                if len(received) > _STREAM_CACHE_MAX:
+                    received = None
+            parts.append("")
+            _emit_accessory(parts, accessory)
+        
+        count, error = await stream_api_items("/api/accessories", _on_accessory)
+        if error:
+            return f"❌ Error fetching accessories: {error}"
+        
+        if not count:
+            return "📱 No accessories found"
+        
+        if received is not None:
+            _store_accessories(received, generation)
+        parts[0] = f"📱 Found {count} accessories:"
+        return "\n".join(parts)
+    
+    data, error = await _get_accessories()
     if error:
         return f"❌ Error fetching accessories: {error}"
     
     if not data:
         return "📱 No accessories found"
     
-    # Group accessories by room/type
-    accessories_info = []
+    parts = [f"📱 Found {len(data)} accessories:"]
     for accessory in data:
-        accessories_info.append(format_accessory_info(accessory))
+        parts.append("")
+        _emit_accessory(parts, accessory)
     
-    if not accessories_info:
-        return "📱 No accessories found"
-    
-    return f"📱 Found {len(accessories_info)} accessories:\n\n" + "\n\n".join(accessories_info)
+    return "\n".join(parts)
 
 @mcp.tool()
 async def get_accessories_layout() -> str:
@@ -199,7 +539,7 @@ async def get_accessories_layout() -> str:
     if not layout_info:
         return "🏠 No rooms configured"
     
-    return f"🏠 Home Layout:\n\n" + "\n\n".join(layout_info)
+    return "🏠 Home Layout:\n\n" + "\n\n".join(layout_info)
 
 @mcp.tool()
 async def get_accessory_details(unique_id: str = "") -> str:
@@ -207,9 +547,9 @@ async def get_accessory_details(unique_id: str = "") -> str:
     if not unique_id.strip():
         return "❌ Error: unique_id parameter is required"
     
-    logger.info(f"Fetching details for accessory: {unique_id}")
+    logger.info("Fetching details for accessory: %s", unique_id)
     
-    data, error = await make_api_request("GET", f"/api/accessories/{unique_id}")
+    data, error = await make_api_request("GET", _ACC_PATH.format(unique_id))
     if error:
         return f"❌ Error fetching accessory details: {error}"
     
@@ -242,18 +582,17 @@ async def get_accessory_details(unique_id: str = "") -> str:
         
         perm_str = " | ".join(permissions) if permissions else "No permissions"
         
-        if "On" in char_type:
+        simple_name = _short(char_type)
+        fmt = _CHAR_FORMATTERS.get(simple_name)
+        
+        if simple_name == "On":
             status = "🟢 On" if value else "🔴 Off"
             details.append(f"   • Power: {status} ({perm_str})")
-        elif "Brightness" in char_type:
-            details.append(f"   • Brightness: {value}% ({perm_str})")
-        elif "Hue" in char_type:
-            details.append(f"   • Hue: {value}° ({perm_str})")
-        elif "Saturation" in char_type:
-            details.append(f"   • Saturation: {value}% ({perm_str})")
+        elif fmt:
+            label, shown = fmt(value)
+            details.append(f"   • {label}: {shown} ({perm_str})")
         else:
             # Show other characteristics with simplified names
-            simple_name = char_type.split(".")[-1] if "." in char_type else char_type
             details.append(f"   • {simple_name}: {value} ({perm_str})")
     
     return "\n".join(details)
@@ -267,43 +606,24 @@ async def control_accessory(unique_id: str = "", action: str = "", value: str =
     if not action.strip():
         return "❌ Error: action parameter is required (e.g., 'power', 'brightness', 'hue', 'saturation')"
     
-    logger.info(f"Controlling accessory {unique_id}: {action} = {value}")
+    logger.info("Controlling accessory %s: %s = %s", unique_id, action, value)
     
-    # First, get current accessory state
-    current_data, error = await make_api_request("GET", f"/api/accessories/{unique_id}")
-    if error:
-        return f"❌ Error fetching current state: {error}"
-    
-    if not current_data:
-        return f"❌ Accessory not found: {unique_id}"
-    
-    # Find the appropriate characteristic for this action
-    characteristics = current_data.get("serviceCharacteristics", [])
-    target_char = find_characteristic_by_action(characteristics, action)
+    action_lower = action.lower()
+    cache_key = (unique_id, action_lower)
+    cached = _char_type_cache.get(cache_key)
     
-    if not target_char:
-        available_actions = []
-        for char in characteristics:
-            if char.get("canWrite", False):
-                char_type = char.get("type", "")
-                if "On" in char_type:
-                    available_actions.append("power")
-                elif "Brightness" in char_type:
-                    available_actions.append("brightness")
-                elif "Hue" in char_type:
-                    available_actions.append("hue")
-                elif "Saturation" in char_type:
-                    available_actions.append("saturation")
-        
-        available_str = ", ".join(set(available_actions)) if available_actions else "none"
-        return f"❌ Error: action '{action}' not supported. Available actions: {available_str}"
+    # Reuse a known characteristic type, otherwise read the accessory to find it
+    if cached:
+        char_type, accessory_name = cached
+    else:
+        char_type, accessory_name, error = await _discover_characteristic(unique_id, action)
+        if error:
+            return error
     
     # Prepare the target value based on action type
-    action_lower = action.lower()
-    
-    if action_lower in ["power", "on", "off"]:
+    if action_lower in _POWER_ACTIONS:
         if value.strip():
-            target_value = value.lower() in ["on", "true", "1", "yes"]
+            target_value = value.lower() in _TRUTHY
         elif action_lower == "off":
             target_value = False
         else:
@@ -342,21 +662,36 @@ async def control_accessory(unique_id: str = "", action: str = "", value: str =
         except ValueError:
             return f"❌ Error: invalid saturation value: {value}"
     
+    path = _ACC_PATH.format(unique_id)
+    
     # Use the correct format from Swagger documentation
     payload = {
-        "characteristicType": target_char["type"],  # Use the exact type from the characteristic (e.g., "On")
+        "characteristicType": char_type,
         "value": target_value
     }
     
-    logger.info(f"Sending payload: {json.dumps(payload, indent=2)}")
+    logger.info("Sending payload: %s", payload)
     
-    result, error = await make_api_request("PUT", f"/api/accessories/{unique_id}", payload)
+    result, error = await make_api_request("PUT", path, payload)
+    
+    if error and cached and error.startswith(("HTTP 400", "HTTP 404")):
+        # The cached characteristic may be stale; rediscover it and try once more
+        _char_type_cache.pop(cache_key, None)
+        char_type, accessory_name, error = await _discover_characteristic(unique_id, action)
+        if error:
+            return error
+        
+        payload["characteristicType"] = char_type
+        logger.info("Sending payload: %s", payload)
+        result, error = await make_api_request("PUT", path, payload)
     
     if error:
         return f"❌ Error controlling accessory: {error}"
     
+    _char_type_cache[cache_key] = (char_type, accessory_name)
+    _invalidate_accessories()
+    
     # Format success message
-    accessory_name = current_data.get("serviceName", unique_id)
     action_description = f"{action} = {value}" if value.strip() else action
     
     return f"✅ Successfully controlled {accessory_name}: {action_description}"
@@ -371,55 +706,37 @@ async def reset_cached_accessories() -> str:
     if error:
         return f"❌ Error resetting cached accessories: {error}"
     
+    _invalidate_accessories()
+    _char_type_cache.clear()
+    
     return "✅ Successfully reset cached accessories. Homebridge will rediscover all accessories with updated names and configurations. Wait a few moments and then list accessories again to see the changes."
+
+@mcp.tool()
+async def quick_toggle(unique_id: str = "") -> str:
     """Quickly toggle an accessory's power state (on/off)."""
     if not unique_id.strip():
         return "❌ Error: unique_id parameter is required"
     
-    logger.info(f"Quick toggling accessory: {unique_id}")
+    logger.info("Quick toggling accessory: %s", unique_id)
     
     # Get current state
-    current_data, error = await make_api_request("GET", f"/api/accessories/{unique_id}")
+    current_data, error = await make_api_request("GET", _ACC_PATH.format(unique_id))
     if error:
         return f"❌ Error fetching current state: {error}"
     
     if not current_data:
         return f"❌ Accessory not found: {unique_id}"
     
-    # Find current power state
-    current_power = None
-    power_char = None
-    
-    for char in current_data.get("serviceCharacteristics", []):
-        if "On" in char.get("type", "") and char.get("canWrite", False):
-            current_power = char.get("value")
-            power_char = char
-            break
-    
+    power_char = find_characteristic_by_action(current_data.get("serviceCharacteristics", []), "power")
     if power_char is None:
         return "❌ Error: This accessory doesn't support power control"
     
-    # Toggle the power state
-    new_power = not bool(current_power)
-    
-    # Use the correct format from Swagger documentation
-    payload = {
-        "characteristicType": power_char["type"],  # Use the actual type from the characteristic (e.g., "On")
-        "value": new_power
-    }
-    
-    logger.info(f"Sending toggle payload: {json.dumps(payload, indent=2)}")
-    
-    result, error = await make_api_request("PUT", f"/api/accessories/{unique_id}", payload)
-    
-    if error:
-        return f"❌ Error toggling accessory: {error}"
+    ok, message = await _set_power(unique_id, power_char)
+    if not ok:
+        return f"❌ Error toggling accessory: {message}"
     
     accessory_name = current_data.get("serviceName", unique_id)
-    new_state = "🟢 On" if new_power else "🔴 Off"
-    old_state = "🟢 On" if current_power else "🔴 Off"
-    
-    return f"✅ Toggled {accessory_name}: {old_state} → {new_state}"
+    return f"✅ Toggled {accessory_name}: {message}"
 
 @mcp.tool()
 async def create_room_groups() -> str:
@@ -427,7 +744,7 @@ async def create_room_groups() -> str:
     logger.info("Creating room-based organization")
     
     # Get all accessories
-    data, error = await make_api_request("GET", "/api/accessories")
+    data, error = await _get_accessories()
     if error:
         return f"❌ Error fetching accessories: {error}"
     
@@ -448,30 +765,16 @@ async def create_room_groups() -> str:
         }
         
         # Smart room detection based on names
-        if any(keyword in name for keyword in ["sala", "living", "salon"]):
-            room_suggestions.setdefault("Sala", []).append(accessory_info)
-        elif any(keyword in name for keyword in ["comedor", "dining"]):
-            room_suggestions.setdefault("Comedor", []).append(accessory_info)
-        elif any(keyword in name for keyword in ["entrada", "entry", "hall"]):
-            room_suggestions.setdefault("Entrada", []).append(accessory_info)
-        elif any(keyword in name for keyword in ["jardin", "garden", "patio"]):
-            room_suggestions.setdefault("Jardín", []).append(accessory_info)
-        elif any(keyword in name for keyword in ["garage"]):
-            room_suggestions.setdefault("Garage", []).append(accessory_info)
-        elif any(keyword in name for keyword in ["navidad", "christmas", "arbol"]):
-            room_suggestions.setdefault("Decoración", []).append(accessory_info)
-        elif any(keyword in name for keyword in ["luz", "light"]):
+        match = _ROOM_RE.match(name)
+        if match is None:
+            unassigned.append(accessory_info)
+        elif match.lastgroup == "Luz":
             # Group lights by position
-            if "derecha" in name or "right" in name:
-                room_suggestions.setdefault("Luces - Derecha", []).append(accessory_info)
-            elif "izquierda" in name or "left" in name:
-                room_suggestions.setdefault("Luces - Izquierda", []).append(accessory_info)
-            else:
-                room_suggestions.setdefault("Luces - Otros", []).append(accessory_info)
-        elif "switch" in name:
-            room_suggestions.setdefault("Switches", []).append(accessory_info)
+            side = _SIDE_RE.match(name)
+            room = _SIDE_LABELS[side.lastgroup] if side else "Luces - Otros"
+            room_suggestions.setdefault(room, []).append(accessory_info)
         else:
-            unassigned.append(accessory_info)
+            room_suggestions.setdefault(_ROOM_LABELS[match.lastgroup], []).append(accessory_info)
     
     # Format the output
     result = ["🏠 Organización sugerida por habitaciones:\n"]
@@ -503,10 +806,10 @@ async def control_room_devices(room_pattern: str = "", action: str = "power", va
     if not room_pattern.strip():
         return "❌ Error: room_pattern parameter is required (e.g., 'sala', 'comedor', 'luz')"
     
-    logger.info(f"Controlling room devices matching: {room_pattern}")
+    logger.info("Controlling room devices matching: %s", room_pattern)
     
     # Get all accessories
-    data, error = await make_api_request("GET", "/api/accessories")
+    data, error = await _get_accessories()
     if error:
         return f"❌ Error fetching accessories: {error}"
     
@@ -520,15 +823,10 @@ async def control_room_devices(room_pattern: str = "", action: str = "power", va
     for accessory in data:
         name = accessory.get("serviceName", "").lower()
         if pattern in name:
-            # Check if it has controllable characteristics
-            has_power = False
-            for char in accessory.get("serviceCharacteristics", []):
-                if "On" in char.get("type", "") and char.get("canWrite", False):
-                    has_power = True
-                    break
-            
-            if has_power:
-                matching_accessories.append(accessory)
+            # Keep the power characteristic (and its current value) from the listing
+            power_char = find_characteristic_by_action(accessory.get("serviceCharacteristics", []), "power")
+            if power_char:
+                matching_accessories.append((accessory, power_char))
     
     if not matching_accessories:
         return f"❌ No se encontraron dispositivos controlables que coincidan con '{room_pattern}'"
@@ -537,123 +835,30 @@ async def control_room_devices(room_pattern: str = "", action: str = "power", va
     results = []
     results.append(f"🎯 Controlando {len(matching_accessories)} dispositivos que coinciden con '{room_pattern}':\n")
     
-    for accessory in matching_accessories:
-        unique_id = accessory.get("uniqueId", "")
+    # None toggles each device; otherwise set them all to the requested state
+    target = None if value.lower() == "toggle" else value.lower() in _TRUTHY
+    
+    async def _handle(accessory, power_char):
         name = accessory.get("serviceName", "Unknown")
         
-        try:
-            if value.lower() == "toggle":
-                # Use quick_toggle for each device
-                current_data, error = await make_api_request("GET", f"/api/accessories/{unique_id}")
-                if error:
-                    results.append(f"❌ {name}: Error obteniendo estado - {error}")
-                    continue
-                
-                # Find current power state
-                current_power = None
-                power_char = None
-                
-                for char in current_data.get("serviceCharacteristics", []):
-                    if "On" in char.get("type", "") and char.get("canWrite", False):
-                        current_power = char.get("value")
-                        power_char = char
-                        break
-                
-                if power_char:
-                    new_power = not bool(current_power)
-                    payload = {
-                        "characteristicType": power_char["type"],
-                        "value": new_power
-                    }
-                    
-                    result, error = await make_api_request("PUT", f"/api/accessories/{unique_id}", payload)
-                    if error:
-                        results.append(f"❌ {name}: Error - {error}")
-                    else:
-                        old_state = "🟢 On" if current_power else "🔴 Off"
-                        new_state = "🟢 On" if new_power else "🔴 Off"
-                        results.append(f"✅ {name}: {old_state} → {new_state}")
-                else:
-                    results.append(f"❌ {name}: No se puede controlar")
-            else:
-                # Use specific value
-                target_value = value.lower() in ["on", "true", "1", "yes"]
-                
-                # Find power characteristic
-                power_char = None
-                for char in accessory.get("serviceCharacteristics", []):
-                    if "On" in char.get("type", "") and char.get("canWrite", False):
-                        power_char = char
-                        break
-                
-                if power_char:
-                    payload = {
-                        "characteristicType": power_char["type"],
-                        "value": target_value
-                    }
-                    
-                    result, error = await make_api_request("PUT", f"/api/accessories/{unique_id}", payload)
-                    if error:
-                        results.append(f"❌ {name}: Error - {error}")
-                    else:
-                        state = "🟢 On" if target_value else "🔴 Off"
-                        results.append(f"✅ {name}: {state}")
-                else:
-                    results.append(f"❌ {name}: No se puede controlar")
+        async with _room_sem:
+            ok, message = await _set_power(accessory.get("uniqueId", ""), power_char, target)
+        if not ok:
+            return f"❌ {name}: Error - {message}"
         
-        except Exception as e:
-            results.append(f"❌ {name}: Error inesperado - {str(e)}")
-    
-    return "\n".join(results)
-    """Quickly toggle an accessory's power state (on/off)."""
-    if not unique_id.strip():
-        return "❌ Error: unique_id parameter is required"
-    
-    logger.info(f"Quick toggling accessory: {unique_id}")
+        return f"✅ {name}: {message}"
     
-    # Get current state
-    current_data, error = await make_api_request("GET", f"/api/accessories/{unique_id}")
-    if error:
-        return f"❌ Error fetching current state: {error}"
-    
-    if not current_data:
-        return f"❌ Accessory not found: {unique_id}"
-    
-    # Find current power state
-    current_power = None
-    power_char = None
-    
-    for char in current_data.get("serviceCharacteristics", []):
-        if "On" in char.get("type", "") and char.get("canWrite", False):
-            current_power = char.get("value")
-            power_char = char
-            break
-    
-    if power_char is None:
-        return "❌ Error: This accessory doesn't support power control"
-    
-    # Toggle the power state
-    new_power = not bool(current_power)
+    outcomes = await asyncio.gather(*[_handle(*match) for match in matching_accessories], return_exceptions=True)
     
-    payload = {
-        "characteristics": [{
-            "characteristicType": HOMEKIT_CHARACTERISTIC_UUIDS["On"],  # Use the correct UUID
-            "value": new_power
-        }]
-    }
-    
-    logger.info(f"Sending toggle payload: {json.dumps(payload, indent=2)}")
-    
-    result, error = await make_api_request("PUT", f"/api/accessories/{unique_id}", payload)
-    
-    if error:
-        return f"❌ Error toggling accessory: {error}"
-    
-    accessory_name = current_data.get("serviceName", unique_id)
-    new_state = "🟢 On" if new_power else "🔴 Off"
-    old_state = "🟢 On" if current_power else "🔴 Off"
+    # gather preserves input order, so results line up with matching_accessories
+    for (accessory, _), outcome in zip(matching_accessories, outcomes):
+        if isinstance(outcome, Exception):
+            name = accessory.get("serviceName", "Unknown")
+            results.append(f"❌ {name}: Error inesperado - {str(outcome)}")
+        else:
+            results.append(outcome)
     
-    return f"✅ Toggled {accessory_name}: {old_state} → {new_state}"
+    return "\n".join(results)
 
 # === SERVER STARTUP ===
 if __name__ == "__main__":